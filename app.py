@@ -1,19 +1,88 @@
+import asyncio
+import hashlib
+import hmac
+import threading
+import time
+
 import streamlit as st
-import stripe
+
+st.set_page_config(page_title="Stripe Link Generator", page_icon="💳")
+st.title("💳 Payment Link Generator")
 
 # --- 1. Password Protection ---
+# Secrets are re-read at most once a minute, so a changed password takes effect
+# without a restart
+SECRETS_TTL = 60
+
+@st.cache_resource(ttl=SECRETS_TTL, show_spinner=False)
+def _app_password():
+    """Read the secret once a minute instead of on every rerun."""
+    return st.secrets["APP_PASSWORD"]
+
+# A signed "?auth=" token lets a reload or a new tab skip the password prompt until it
+# expires. Tokens are only issued when AUTH_TOKEN_SECRET is set: the URL leaks through
+# history and shared links, so the key must not be guessable from the team password.
+# The key also mixes in the password, so changing either secret revokes every token
+# (within SECRETS_TTL).
+AUTH_TOKEN_TTL = 12 * 3600
+
+@st.cache_resource(ttl=SECRETS_TTL, show_spinner=False)
+def _auth_token_key():
+    """Signing key for auth tokens, or None when AUTH_TOKEN_SECRET isn't configured."""
+    secret = st.secrets.get("AUTH_TOKEN_SECRET")
+    if not secret:
+        return None
+    return hmac.new(secret.encode(), _app_password().encode(), hashlib.sha256).digest()
+
+def _token_signature(key, issued_at):
+    return hmac.new(key, str(issued_at).encode(), hashlib.sha256).hexdigest().encode()
+
+def _issue_auth_token():
+    """A fresh token, or None when tokens are disabled."""
+    key = _auth_token_key()
+    if key is None:
+        return None
+    issued_at = int(time.time())
+    return f"{issued_at}.{_token_signature(key, issued_at).decode()}"
+
+def _auth_token_valid(token):
+    """True only for an unexpired token we signed; anything malformed is just invalid."""
+    key = _auth_token_key()
+    if key is None or not token:
+        return False
+    issued_at, _, signature = token.partition(".")
+    # isdigit() alone lets through things like "²" that int() rejects
+    if not (issued_at.isascii() and issued_at.isdigit()):
+        return False
+    if time.time() - int(issued_at) > AUTH_TOKEN_TTL:
+        return False
+    try:
+        signature = signature.encode("ascii")
+    except UnicodeEncodeError:
+        return False
+    return hmac.compare_digest(signature, _token_signature(key, int(issued_at)))
+
+def _start_prefetch():
+    """Warm the catalog and coupon pool in the background, once per login."""
+    from stripe_helpers import prefetch_stripe_data
+    threading.Thread(target=prefetch_stripe_data, daemon=True).start()
+
 def check_password():
     """Returns `True` if the user had the correct password."""
+    # Authenticated reruns stop here: one session_state read, no secrets access
+    if st.session_state.setdefault("password_correct", False):
+        return True
+
     try:
-        actual_password = st.secrets["APP_PASSWORD"] 
+        _app_password()
     except (FileNotFoundError, KeyError):
         st.error("Secrets not found. Please add APP_PASSWORD to secrets.")
         return False
 
-    if "password_correct" not in st.session_state:
-        st.session_state.password_correct = False
-
-    if st.session_state.password_correct:
+    # New session with a still-valid token: no prompt, just the one HMAC check
+    if _auth_token_valid(st.query_params.get("auth")):
+        st.session_state.password_correct = True
+        _start_prefetch()
         return True
 
     st.text_input(
@@ -23,16 +92,24 @@ def check_password():
         key="password_input"
     )
     
-    if "password_error" in st.session_state:
-        st.error(st.session_state.password_error)
+    password_error = st.session_state.get("password_error")
+    if password_error:
+        st.error(password_error)
         
     return False
 
 def password_entered():
-    if st.session_state["password_input"] == st.secrets["APP_PASSWORD"]:
+    # Constant-time compare; bytes so non-ASCII passwords work too
+    if hmac.compare_digest(st.session_state["password_input"].encode(), _app_password().encode()):
         st.session_state.password_correct = True
-        if "password_error" in st.session_state:
-            del st.session_state.password_error
+        st.session_state.pop("password_error", None)
+        # Don't keep the plaintext password around for the rest of the session
+        del st.session_state["password_input"]
+        token = _issue_auth_token()
+        if token:
+            st.query_params["auth"] = token
+        # Start the Stripe fetches now so they overlap with the rerun that follows
+        _start_prefetch()
     else:
         st.session_state.password_correct = False
         st.session_state.password_error = "😕 Password incorrect"
@@ -42,110 +119,53 @@ if not check_password():
     st.stop()
 
 # --- 2. App Configuration & Auth ---
-st.set_page_config(page_title="Stripe Link Generator", page_icon="💳")
-st.title("💳 Payment Link Generator")
+# Imported only past the password check, so the login screen never loads the Stripe SDK
+from stripe_helpers import (
+    ProductTable,
+    clear_customer_lookups,
+    collect_garbage,
+    coupon_id_for,
+    create_checkout_session,
+    create_checkout_sessions,
+    get_active_products,
+    get_or_create_customer,
+    init_stripe,
+    metadata_blob,
+    refresh_product_catalog,
+    run_async,
+    start_async,
+)
 
 try:
-    stripe.api_key = st.secrets["STRIPE_API_KEY"]
+    init_stripe()
 except KeyError:
     st.error("STRIPE_API_KEY not found. Check your Advanced Settings.")
     st.stop()
 
-# --- 3. Helper Functions ---
-@st.cache_data(ttl=300)
-def get_active_products():
-    """Fetch active prices, detect mode, and detect frequency (month/year)."""
-    try:
-        prices = stripe.Price.list(active=True, limit=50, expand=['data.product'])
-        product_options = {}
-        for p in prices.data:
-            amount = p.unit_amount / 100 if p.unit_amount else 0
-            currency = p.currency.upper()
-            product_name = p.product.name if hasattr(p.product, 'name') else "Unknown Product"
-            
-            # DETECT TYPE & FREQUENCY
-            price_type = p.type # 'recurring' or 'one_time'
-            
-            if price_type == 'recurring' and p.recurring:
-                interval = p.recurring.interval # e.g., 'month', 'year'
-                api_mode = 'subscription'
-                label_suffix = f"/{interval}"
-            else:
-                interval = "one-time"
-                api_mode = 'payment'
-                label_suffix = ""
-
-            label = f"{product_name} ({amount} {currency}{label_suffix})"
-            
-            product_options[label] = {
-                "id": p.id,
-                "amount": amount,
-                "currency": currency,
-                "mode": api_mode,
-                "interval": interval # Store this to use in metadata later
-            }
-        return product_options
-    except Exception as e:
-        st.error(f"Error connecting to Stripe: {e}")
-        return {}
-
-def create_checkout_session(customer_id, price_id, mode, discount_percent=0, metadata=None):
-    """
-    Creates the session with Metadata injected.
-    """
-    try:
-        # 1. Prepare Base Metadata
-        if metadata is None:
-            metadata = {}
-        
-        # Add a system tag
-        metadata['generated_by'] = "CSM App"
-
-        session_args = {
-            'customer': customer_id,
-            'line_items': [{'price': price_id, 'quantity': 1}],
-            'mode': mode,
-            'success_url': 'https://example.com/success',
-            'customer_update': {'name': 'auto', 'address': 'auto'},
-            'metadata': metadata # Attach to the Session
-        }
-
-        # 2. If Subscription, attach metadata to the Subscription object too
-        if mode == 'subscription':
-            session_args['subscription_data'] = {
-                'metadata': metadata 
-            }
-
-        # 3. Apply Discounts
-        if discount_percent > 0:
-            coupon = stripe.Coupon.create(
-                percent_off=discount_percent,
-                duration='once',
-                name=f"{discount_percent}% Off (CSM Generated)"
-            )
-            session_args['discounts'] = [{'coupon': coupon.id}]
-
-        session = stripe.checkout.Session.create(**session_args)
-        return session.url
-    except Exception as e:
-        return f"Error: {str(e)}"
-
-def get_or_create_customer(email, name):
-    try:
-        search = stripe.Customer.list(email=email, limit=1)
-        if search.data:
-            return search.data[0].id, True
-        
-        new_cus = stripe.Customer.create(email=email, name=name)
-        return new_cus.id, False
-    except Exception as e:
-        return None, False
+# --- 3. Main Interface ---
 
-# --- 4. Main Interface ---
+# Rendered before the fetch so it's reachable even when the catalog comes back empty.
+# The callback runs before the rerun, so the fetch below is already fresh.
+st.sidebar.button(
+    "🔄 Refresh product catalog",
+    on_click=refresh_product_catalog,
+    help="Reload prices from Stripe now instead of waiting for the cache to expire."
+)
+st.sidebar.button(
+    "🧹 Clear cached lookups",
+    on_click=clear_customer_lookups,
+    help="Forget the customer email lookups held in memory (for every user of this app)."
+)
 
-product_map = get_active_products()
+try:
+    # Only visible on a cold cache; warm reruns return the shared table immediately
+    with st.spinner("Loading products from Stripe..."):
+        products = get_active_products()
+except Exception as e:
+    st.error(f"Error connecting to Stripe: {e}")
+    products = ProductTable()
 
-if not product_map:
+if not products:
     st.warning("No active products found in Stripe account.")
     st.stop()
 
@@ -153,96 +173,175 @@ if not product_map:
 with st.sidebar:
     st.header("Price Settings")
     discount = st.number_input("Discount Percentage (%)", min_value=0, max_value=100, value=0, step=5)
+    unique_code = st.checkbox(
+        "Single-use promotion code",
+        disabled=discount == 0,
+        help="Wrap the discount in a one-off code for this customer, so each link's redemption can be tracked. "
+             "Leave off to apply the shared coupon directly."
+    )
+
+# Discounted prices for the whole catalog, shared by both tabs
+final_prices = products.final_prices(discount)
+discount_delta = f"-{discount}%" if discount else None
+
+# Shared by both tabs
+def render_product_selector(key, products, final_prices, discount_delta):
+    """Product picker plus price metric. Returns (idx, final_price, frequency); idx is None if nothing is selected."""
+    # The widget holds a row index, not the label. The key carries the catalog version so
+    # a refresh that reorders the rows resets the pick instead of moving it to another price.
+    idx = st.selectbox(
+        "Select Product",
+        options=range(len(products)),
+        format_func=products.options.__getitem__,
+        key=f"{key}-{products.version}"
+    )
+    if idx is None:
+        return None, 0, "unknown"
+
+    # Calculate Data for Metadata
+    currency = products.currencies[idx]
+    final_price = float(final_prices[idx])
+
+    if discount_delta:
+        st.metric("Final Price", f"{final_price:.2f} {currency}", discount_delta)
+    else:
+        st.metric("Price", f"{products.amounts[idx]} {currency}")
+    return idx, final_price, products.intervals[idx]
 
-tab1, tab2 = st.tabs(["Search / Existing Customer", "Create New Customer"])
+def render_generate_button(button_label, products, idx, discount, unique_code, final_price, frequency, resolve_customer):
+    """
+    Button + link generation. resolve_customer() returns the customer ID to bill,
+    or None (after showing its own message) to abort.
+    """
+    if not st.button(button_label) or idx is None:
+        return
+
+    # The coupon doesn't depend on the customer, so resolve it while the customer
+    # lookup/create (tab 2) is in flight
+    coupon_future = start_async(asyncio.to_thread(coupon_id_for, discount)) if discount > 0 else None
+
+    cus_id = resolve_customer()
+    if not cus_id:
+        return
+
+    coupon_id = None
+    if coupon_future is not None:
+        try:
+            coupon_id = coupon_future.result()
+        except Exception:
+            pass # create_checkout_session retries the lookup and reports the error
+
+    my_metadata = metadata_blob(round(final_price * 100), frequency)
+
+    link, err = run_async(create_checkout_session(
+        cus_id, products.ids[idx], products.modes[idx], discount,
+        metadata=my_metadata, unique_code=unique_code, coupon_id=coupon_id
+    ))
+
+    if err is not None:
+        st.error(f"Error: {err}")
+    else:
+        st.success(f"Link Created! (Metadata: {frequency}, {final_price:.2f})")
+        st.code(link, language="text")
+
+def render_batch_generate(button_label, products, final_prices, discount, unique_code, resolve_customer):
+    """Multiselect + one button that creates a link per selected product, all in one go."""
+    picked = st.multiselect(
+        "Select Products",
+        options=range(len(products)),
+        format_func=products.options.__getitem__,
+        key=f"batch-{products.version}" # same reset-on-reorder rule as the selectboxes
+    )
+    if not st.button(button_label) or not picked:
+        return
+
+    cus_id = resolve_customer()
+    if not cus_id:
+        return
+
+    items = [
+        (products.ids[i], products.modes[i], metadata_blob(round(float(final_prices[i]) * 100), products.intervals[i]))
+        for i in picked
+    ]
+    with st.spinner(f"Creating {len(items)} links..."):
+        results = run_async(create_checkout_sessions(cus_id, items, discount, unique_code=unique_code))
+
+    for i, (link, err) in zip(picked, results):
+        if err is not None:
+            st.error(f"{products.options[i]}: Error: {err}")
+        else:
+            st.success(f"Link Created for {products.options[i]}")
+            st.code(link, language="text")
+
+# Each tab body is a fragment: typing in its inputs, picking a product (and so
+# redrawing the price metric) or clicking its button reruns only that tab, not
+# the password check, catalog lookup and sidebar. Changing the sidebar settings
+# still reruns everything, so the prices update. (A fragment can't own sidebar
+# widgets that the tabs read, so that part can't be narrowed further.)
 
 # === TAB 1: EXISTING CUSTOMER ===
-with tab1:
+@st.fragment
+def tab1_body(products, discount, unique_code, final_prices, discount_delta):
     st.subheader("Existing Customer")
     existing_cus_id = st.text_input("Customer ID (e.g., cus_1234)")
-    selected_label_1 = st.selectbox("Select Product", options=product_map.keys(), key="sel1")
-    
-    # Calculate Data for Metadata
-    final_price_1 = 0
-    frequency_1 = "unknown"
-    
-    if selected_label_1:
-        prod_data = product_map[selected_label_1]
-        final_price_1 = prod_data['amount'] * (1 - (discount / 100))
-        frequency_1 = prod_data['interval']
-        
-        if discount > 0:
-            st.metric("Final Price", f"{final_price_1:.2f} {prod_data['currency']}", f"-{discount}%")
-        else:
-            st.metric("Price", f"{prod_data['amount']} {prod_data['currency']}")
-
-    if st.button("Generate Link (Existing)"):
-        if existing_cus_id and selected_label_1:
-            price_id = product_map[selected_label_1]['id']
-            mode = product_map[selected_label_1]['mode']
-            
-            # Prepare Metadata
-            my_metadata = {
-                "amount_paid": f"{final_price_1:.2f}",
-                "payment_frequency": frequency_1
-            }
-
-            link = create_checkout_session(existing_cus_id, price_id, mode, discount, metadata=my_metadata)
-            
-            if "Error" in link:
-                st.error(link)
-            else:
-                st.success(f"Link Created! (Metadata: {frequency_1}, {final_price_1:.2f})")
-                st.code(link, language="text")
+
+    if st.toggle("Batch mode", help="Pick several products and get a link for each in one go."):
+        render_batch_generate(
+            "Generate Links (Existing)", products, final_prices, discount, unique_code,
+            resolve_customer=lambda: existing_cus_id
+        )
+    else:
+        idx, final_price, frequency = render_product_selector("sel1", products, final_prices, discount_delta)
+
+        render_generate_button(
+            "Generate Link (Existing)", products, idx, discount, unique_code, final_price, frequency,
+            resolve_customer=lambda: existing_cus_id
+        )
+
+    # Every full and fragment rerun ends in a tab body, after the page is drawn
+    collect_garbage()
 
 # === TAB 2: NEW CUSTOMER ===
-with tab2:
+@st.fragment
+def tab2_body(products, discount, unique_code, final_prices, discount_delta):
     st.subheader("New Customer")
     col1, col2 = st.columns(2)
     with col1:
         new_email = st.text_input("Email")
     with col2:
         new_name = st.text_input("Name")
-    
-    selected_label_2 = st.selectbox("Select Product", options=product_map.keys(), key="sel2")
-    
-    # Calculate Data for Metadata
-    final_price_2 = 0
-    frequency_2 = "unknown"
 
-    if selected_label_2:
-        prod_data = product_map[selected_label_2]
-        final_price_2 = prod_data['amount'] * (1 - (discount / 100))
-        frequency_2 = prod_data['interval']
-        
-        if discount > 0:
-            st.metric("Final Price", f"{final_price_2:.2f} {prod_data['currency']}", f"-{discount}%")
-
-    if st.button("Create & Generate"):
-        if new_email and new_name and selected_label_2:
-            price_id = product_map[selected_label_2]['id']
-            mode = product_map[selected_label_2]['mode']
-            
-            with st.spinner("Checking database..."):
-                cus_id, is_duplicate = get_or_create_customer(new_email, new_name)
-                
-                if cus_id:
-                    if is_duplicate:
-                        st.warning(f"⚠️ Account exists! Using existing ID: {cus_id}")
-                    else:
-                        st.success(f"✅ New Customer created: {cus_id}")
-                    
-                    # Prepare Metadata
-                    my_metadata = {
-                        "amount_paid": f"{final_price_2:.2f}",
-                        "payment_frequency": frequency_2
-                    }
-                    
-                    link = create_checkout_session(cus_id, price_id, mode, discount, metadata=my_metadata)
-                    
-                    if "Error" in link:
-                        st.error(link)
-                    else:
-                        st.code(link, language="text")
-                else:
-                    st.error("Failed to process customer (API Error).")
\ No newline at end of file
+    idx, final_price, frequency = render_product_selector("sel2", products, final_prices, discount_delta)
+
+    def resolve_customer():
+        if not (new_email and new_name):
+            return None
+
+        with st.spinner("Checking database..."):
+            cus_id, is_duplicate = run_async(get_or_create_customer(new_email, new_name))
+
+        if not cus_id:
+            st.error("Failed to process customer (API Error).")
+        elif is_duplicate:
+            st.warning(f"⚠️ Account exists! Using existing ID: {cus_id}")
+        else:
+            st.success(f"✅ New Customer created: {cus_id}")
+        return cus_id
+
+    render_generate_button(
+        "Create & Generate", products, idx, discount, unique_code, final_price, frequency,
+        resolve_customer=resolve_customer
+    )
+
+    collect_garbage()
+
+# Only the selected tab runs; switching tabs triggers a rerun
+tab1, tab2 = st.tabs(["Search / Existing Customer", "Create New Customer"], key="active_tab", on_change="rerun")
+
+with tab1:
+    if tab1.open:
+        tab1_body(products, discount, unique_code, final_prices, discount_delta)
+
+with tab2:
+    if tab2.open:
+        tab2_body(products, discount, unique_code, final_prices, discount_delta)
@@ -0,0 +1,603 @@
+"""
+Stripe, cache and event-loop helpers for app.py.
+
+Kept in their own module so they are imported (and their caches decorated)
+once per process; Streamlit only re-executes app.py itself on each rerun.
+"""
+import asyncio
+import gc
+import hashlib
+import json
+import os
+import ssl
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+import aiohttp
+import numpy as np
+import requests
+import streamlit as st
+import stripe
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import redis
+except ImportError: # optional; only used when REDIS_URL is set in secrets
+    redis = None
+
+try:
+    from orjson import loads as _json_loads
+except ImportError: # optional; the stdlib parser is just slower
+    _json_loads = json.loads
+
+# Opt-in (DISABLE_GC=1): no automatic cyclic GC passes in the middle of a click.
+# Reruns and clicks do leave reference cycles behind (Streamlit, asyncio, the SDK), so
+# collection is deferred rather than skipped: collect_garbage() runs at the end of every
+# tab render, and the catalog build collects too.
+DISABLE_GC = os.environ.get("DISABLE_GC", "").lower() in ("1", "true", "yes")
+if DISABLE_GC:
+    gc.disable()
+
+# Tracked objects that may pile up before collect_garbage() does a full pass
+# (a rerun or click leaves a few hundred)
+GC_COLLECT_AFTER = 20_000
+
+def collect_garbage():
+    """Deferred GC for DISABLE_GC: a full pass once enough has piled up. A no-op otherwise."""
+    if DISABLE_GC and gc.get_count()[0] >= GC_COLLECT_AFTER:
+        gc.collect()
+
+@st.cache_resource
+def _http_session():
+    """One shared keep-alive pool, big enough for the coupon pool's 20 parallel creates."""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+    return session
+
+@st.cache_resource
+def _read_session():
+    """
+    Keep-alive pool for the raw catalog GETs in _list_all(). Separate from the SDK's pool
+    because it retries at the HTTP layer, which the SDK already does for its own calls.
+    """
+    retry = Retry(
+        total=2, # same as stripe.max_network_retries
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET"}),
+        raise_on_status=False # hand back the last response so its Stripe error can be shown
+    )
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=retry))
+    return session
+
+async def _aiohttp_connector():
+    """Keep-alive pool for the *_async calls. Built on the Stripe loop, since aiohttp binds connectors to the running loop."""
+    return aiohttp.TCPConnector(
+        ssl=ssl.create_default_context(cafile=stripe.ca_bundle_path), # what the SDK's own connector verifies against
+        limit=20, # same ceiling as the requests pool
+        keepalive_timeout=60, # aiohttp's 15s default drops the connection between most clicks
+        ttl_dns_cache=300,
+    )
+
+@st.cache_resource(show_spinner=False)
+def init_stripe():
+    """
+    One-shot SDK setup per process: API key from secrets plus the shared HTTP clients.
+    Later calls are a cache hit; a missing key raises KeyError and isn't cached.
+    """
+    stripe.api_key = st.secrets["STRIPE_API_KEY"]
+    # Sync calls keep using requests; the *_async methods go through aiohttp
+    stripe.default_http_client = stripe.RequestsClient(
+        session=_http_session(),
+        async_fallback_client=stripe.AIOHTTPClient(connector=run_async(_aiohttp_connector()))
+    )
+    # Safe: creates carry an idempotency key, except coupons, whose fixed IDs make a
+    # retried create fail with resource_already_exists, which get_or_create_coupon() handles
+    stripe.max_network_retries = 2
+    return True
+
+@st.cache_resource
+def _worker_pool():
+    """
+    Threads for blocking Stripe calls (sync SDK methods, cached helpers), shared by the
+    whole process instead of spinning up a pool per call.
+    """
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="stripe-io")
+
+@st.cache_resource
+def _stripe_event_loop():
+    """
+    One long-lived loop for all async Stripe calls.
+    The aiohttp session is bound to the loop that created it, so a fresh
+    asyncio.run() per click would break it (and lose its keep-alive pool).
+    """
+    loop = asyncio.new_event_loop()
+    loop.set_default_executor(_worker_pool()) # asyncio.to_thread() lands here
+    threading.Thread(target=loop.run_forever, name="stripe-async", daemon=True).start()
+    return loop
+
+def start_async(coro):
+    """Schedule a coroutine on the shared Stripe loop; returns a concurrent.futures.Future."""
+    return asyncio.run_coroutine_threadsafe(coro, _stripe_event_loop())
+
+def run_async(coro):
+    """Run a coroutine on the shared Stripe loop and wait for the result."""
+    return start_async(coro).result()
+
+def idempotency_key(*parts):
+    """Same inputs within the same minute give the same key, so retries and double-clicks don't duplicate objects."""
+    raw = "-".join(str(part) for part in (*parts, int(time.time() // 60)))
+    return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+# Second cache tier, shared across Streamlit processes and restarts
+PRICES_CACHE_KEY = "stripe_prices:active:v1"
+PRICES_CACHE_TTL = 3600 # same as the in-process hard expiry (12 x 5 min, see .streamlit/config.toml)
+CUSTOMER_CACHE_TTL = 10 * 60
+COUPON_CACHE_TTL = 7 * 24 * 3600 # coupon IDs are fixed, this only bounds a coupon deleted in the dashboard
+
+@st.cache_resource(show_spinner=False)
+def _redis_client():
+    """Shared Redis connection, or None when REDIS_URL isn't configured (or redis isn't installed)."""
+    url = st.secrets.get("REDIS_URL")
+    if not url or redis is None:
+        return None
+    return redis.Redis.from_url(url, socket_timeout=1)
+
+def get_generic_cache(key):
+    """JSON value stored under key, or None on a miss. Redis errors count as a miss."""
+    client = _redis_client()
+    if client is None:
+        return None
+    try:
+        raw = client.get(key)
+    except redis.RedisError:
+        return None
+    return json.loads(raw) if raw else None
+
+def set_generic_cache(key, value, ttl):
+    client = _redis_client()
+    if client is None:
+        return
+    try:
+        client.set(key, json.dumps(value), ex=ttl)
+    except redis.RedisError:
+        pass # the cache is an optimisation; Stripe stays the source of truth
+
+def delete_generic_cache(key):
+    client = _redis_client()
+    if client is None:
+        return
+    try:
+        client.delete(key)
+    except redis.RedisError:
+        pass
+
+def _customer_cache_key(email):
+    return "stripe_customer:email:" + hashlib.sha1(email.strip().lower().encode()).hexdigest()
+
+def _coupon_cache_key(percent_off):
+    return f"stripe_coupon:{percent_off}"
+
+def _raise_api_error(r):
+    """Raise a Stripe error carrying the API's own message, like the SDK would."""
+    try:
+        message = _json_loads(r.content)["error"]["message"]
+    except (ValueError, KeyError, TypeError):
+        message = f"HTTP {r.status_code} from {r.url}"
+    raise stripe.APIError(message, http_body=r.text, http_status=r.status_code, headers=dict(r.headers))
+
+def _list_all(path, **params):
+    """
+    Every page of a Stripe listing as plain dicts, 100 objects (the API maximum) per request.
+    Read-only, so it skips the SDK: building a StripeObject tree per price costs more
+    CPU than the request itself on a big catalog.
+    """
+    url = f"{stripe.api_base}/v1/{path}"
+    headers = {"Stripe-Version": stripe.api_version}
+    params = {"limit": 100, **params}
+    objects = []
+    while True:
+        r = _read_session().get(url, params=params, headers=headers, auth=(stripe.api_key, ""), timeout=30)
+        if not r.ok:
+            _raise_api_error(r)
+        page = _json_loads(r.content)
+        objects.extend(page["data"])
+        if not page["has_more"] or not page["data"]:
+            return objects
+        params["starting_after"] = page["data"][-1]["id"]
+
+async def _list_prices_and_products():
+    """Run the price and product listings side by side instead of expanding products per price."""
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(
+        loop.run_in_executor(_worker_pool(), lambda: _list_all("prices", active="true")),
+        loop.run_in_executor(_worker_pool(), lambda: _list_all("products", active="true")),
+    )
+
+# Name for prices whose product isn't in the active product listing
+_UNKNOWN_PRODUCT_NAME = "Unknown Product"
+
+@dataclass(slots=True)
+class ProductTable:
+    """Active prices stored column-wise; a product is an index into every column."""
+    labels: list[str] = field(default_factory=list)
+    ids: list[str] = field(default_factory=list)
+    amounts: array = field(default_factory=lambda: array('d'))
+    currencies: list[str] = field(default_factory=list)
+    modes: list[str] = field(default_factory=list)
+    intervals: list[str] = field(default_factory=list)
+    label_to_idx: dict[str, int] = field(default_factory=dict)
+    final_price_cache: dict[int, np.ndarray] = field(default_factory=dict)
+    options: tuple[str, ...] = () # labels frozen for the selectboxes, set by from_rows()
+    version: int = 0 # changes whenever the label list does, set by from_rows()
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build the table from [label, id, amount, currency, mode, interval] rows."""
+        table = cls()
+        for row in rows:
+            table.add(*row)
+        table.options = tuple(table.labels)
+        table.version = hash(table.options)
+        return table
+
+    def __len__(self):
+        return len(self.labels)
+
+    def add(self, label, price_id, amount, currency, mode, interval):
+        idx = self.label_to_idx.get(label)
+        if idx is None:
+            self.label_to_idx[label] = len(self.labels)
+            self.labels.append(label)
+            self.ids.append(price_id)
+            self.amounts.append(amount)
+            self.currencies.append(currency)
+            self.modes.append(mode)
+            self.intervals.append(interval)
+        else:
+            # Same label twice: the later price wins, as it did with the old dict
+            self.ids[idx] = price_id
+            self.amounts[idx] = amount
+            self.currencies[idx] = currency
+            self.modes[idx] = mode
+            self.intervals[idx] = interval
+
+    def final_prices(self, discount):
+        """Discounted price per row. Built once per discount and kept with the (shared) table, so a refresh drops it too."""
+        prices = self.final_price_cache.get(discount)
+        if prices is None:
+            # One vectorised pass over the whole price column (a zero-copy view of amounts)
+            prices = np.round(np.frombuffer(self.amounts) * (1 - discount / 100), 2)
+            self.final_price_cache[discount] = prices
+        return prices
+
+def _fetch_price_rows():
+    """Fetch active prices, detect mode, and detect frequency (month/year). Returns JSON-friendly rows for ProductTable.add."""
+    prices, products = asyncio.run(_list_prices_and_products())
+    names_by_id = {prod["id"]: prod["name"] for prod in products}
+
+    rows = []
+    for p in prices:
+        amount = p["unit_amount"] / 100 if p["unit_amount"] else 0
+        currency = p["currency"].upper()
+        product_name = names_by_id.get(p["product"], _UNKNOWN_PRODUCT_NAME) # p["product"] is a plain ID
+        
+        # DETECT TYPE & FREQUENCY
+        price_type = p["type"] # 'recurring' or 'one_time'
+        
+        if price_type == 'recurring' and p["recurring"]:
+            interval = p["recurring"]["interval"] # e.g., 'month', 'year'
+            api_mode = 'subscription'
+            label_suffix = f"/{interval}"
+        else:
+            interval = "one-time"
+            api_mode = 'payment'
+            label_suffix = ""
+
+        label = f"{product_name} ({amount} {currency}{label_suffix})"
+        
+        # interval is stored to use in metadata later
+        rows.append([label, p["id"], amount, currency, api_mode, interval])
+    return rows
+
+# Set after the first catalog build in this process; from then on every build is a refresh
+_catalog_loaded = threading.Event()
+
+@st.cache_resource(ttl=300, refresh_mode="background", show_spinner=False)
+def get_active_products():
+    """
+    Active prices as a ProductTable. Shared by all sessions. Once the TTL passes,
+    the stale catalog is still served while Streamlit refreshes it in the background
+    (see .streamlit/config.toml). The optional Redis tier only serves a cold process
+    start; refreshes always go to Stripe and write the result through to Redis.
+    Errors are raised so a failed fetch never gets cached.
+    """
+    rows = None if _catalog_loaded.is_set() else get_generic_cache(PRICES_CACHE_KEY)
+    if rows is None:
+        rows = _fetch_price_rows()
+        set_generic_cache(PRICES_CACHE_KEY, rows, PRICES_CACHE_TTL)
+    _catalog_loaded.set()
+
+    table = ProductTable.from_rows(rows)
+    if DISABLE_GC:
+        # Plain rows/dicts are already freed by refcounting. This sweeps the reference
+        # cycles that piled up since the last build (the throwaway asyncio.run() loop,
+        # exception frames, anything from the click paths). GC stays off afterwards.
+        gc.collect()
+    return table
+
+def refresh_product_catalog():
+    """Drop both cache tiers so the next read comes straight from Stripe."""
+    delete_generic_cache(PRICES_CACHE_KEY)
+    get_active_products.clear()
+
+@st.cache_resource(show_spinner=False)
+def get_or_create_coupon(percent_off):
+    """
+    Returns a coupon ID for this discount. Each percent has one 'once' coupon with a fixed
+    ID, so restarts and other workers find the same coupon instead of creating another.
+    Cached for good (and in Redis for a week); if the coupon is deleted in the dashboard,
+    create_checkout_session() notices and calls _forget_coupon() to recreate it.
+    """
+    cache_key = _coupon_cache_key(percent_off)
+    coupon_id = get_generic_cache(cache_key)
+    if coupon_id:
+        return coupon_id
+
+    coupon_id = f"csm-{percent_off}-once"
+    try:
+        stripe.Coupon.retrieve(coupon_id)
+    except stripe.InvalidRequestError:
+        try:
+            stripe.Coupon.create(
+                id=coupon_id,
+                percent_off=percent_off,
+                duration='once',
+                name=f"{percent_off}% Off (CSM Generated)"
+            )
+        except stripe.InvalidRequestError as e:
+            if e.code != "resource_already_exists":
+                raise
+            # another worker created it between our retrieve and create
+
+    set_generic_cache(cache_key, coupon_id, COUPON_CACHE_TTL)
+    return coupon_id
+
+# The discount input steps by 5, so these cover everything but hand-typed values
+POOLED_DISCOUNTS = range(5, 101, 5)
+
+@st.cache_resource(show_spinner=False)
+def coupon_pool():
+    """Looks up (or creates) one coupon per discount step, returning {percent: coupon_id}."""
+    def create(pct):
+        return pct, get_or_create_coupon(pct)
+
+    # Own short-lived pool: coupon_id_for() may be waiting on this from a shared worker,
+    # so queueing the creates behind it could deadlock
+    with ThreadPoolExecutor(max_workers=len(POOLED_DISCOUNTS)) as pool:
+        return dict(pool.map(create, POOLED_DISCOUNTS))
+
+def _forget_coupon(percent_off):
+    """Drop a coupon ID from every cache tier, e.g. after it was deleted in the dashboard."""
+    get_or_create_coupon.clear(percent_off)
+    delete_generic_cache(_coupon_cache_key(percent_off))
+    coupon_pool().pop(percent_off, None) # coupon_id_for() then falls back to get_or_create_coupon()
+
+def prefetch_stripe_data():
+    """Warm the catalog and coupon caches from a background thread."""
+    try:
+        init_stripe() # may run before the script has set the key
+        get_active_products()
+        coupon_pool()
+    except Exception:
+        pass # the foreground calls retry and report the error
+
+def coupon_id_for(percent_off):
+    """Pooled coupon when there is one, otherwise the same fixed-ID coupon looked up on demand."""
+    return coupon_pool().get(percent_off) or get_or_create_coupon(percent_off)
+
+@lru_cache(maxsize=256)
+def metadata_blob(amount_cents, frequency, extra=()):
+    """
+    Checkout metadata, built once per (amount, frequency, extra pairs).
+    Takes cents so the cache key doesn't depend on float formatting.
+    The dict is shared between callers, so treat it as read-only.
+    """
+    return {
+        "amount_paid": f"{amount_cents // 100}.{amount_cents % 100:02d}",
+        "payment_frequency": frequency,
+        **dict(extra),
+        "generated_by": "CSM App" # system tag
+    }
+
+def build_session_args(customer_id, price_id, mode, metadata=None):
+    """Checkout Session params shared by the discounted and full-price paths."""
+    # 1. Base Metadata (already tagged by metadata_blob; never mutated here)
+    if metadata is None:
+        metadata = {"generated_by": "CSM App"}
+
+    session_args = {
+        'customer': customer_id,
+        'line_items': [{'price': price_id, 'quantity': 1}],
+        'mode': mode,
+        'success_url': 'https://example.com/success',
+        'customer_update': {'name': 'auto', 'address': 'auto'},
+        'metadata': metadata # Attach to the Session
+    }
+
+    # 2. If Subscription, attach metadata to the Subscription object too
+    if mode == 'subscription':
+        session_args['subscription_data'] = {
+            'metadata': metadata 
+        }
+    return session_args
+
+async def _create_discounted_session(session_args, customer_id, coupon_id, unique_code, ikey):
+    """Attach the coupon (directly or via a single-use code) and create the session. Returns the URL."""
+    if unique_code:
+        # The code is derived from the key, so a retried request sends identical params
+        promo = await stripe.PromotionCode.create_async(
+            promotion={'type': 'coupon', 'coupon': coupon_id},
+            code=f"CSM-{ikey[:8].upper()}",
+            customer=customer_id,
+            max_redemptions=1,
+            idempotency_key=f"promo-{ikey}"
+        )
+        session_args['discounts'] = [{'promotion_code': promo.id}]
+    else:
+        session_args['discounts'] = [{'coupon': coupon_id}]
+
+    session = await stripe.checkout.Session.create_async(**session_args, idempotency_key=ikey)
+    return session.url
+
+async def create_checkout_session(customer_id, price_id, mode, discount_percent=0, metadata=None, unique_code=False, coupon_id=None):
+    """
+    Creates the session with Metadata injected.
+    Discounts reuse the shared coupon for that percent (pass coupon_id if it's already
+    resolved); unique_code wraps it in a single-use promotion code instead, for when
+    each link's redemption must be tracked.
+    Returns (url, None) on success or (None, error message). Drive it with run_async().
+    """
+    try:
+        ikey = idempotency_key(customer_id, price_id, discount_percent, unique_code)
+
+        # Fast path: no discount (the default) is one Session call and nothing else
+        if discount_percent <= 0:
+            session_args = build_session_args(customer_id, price_id, mode, metadata)
+            session = await stripe.checkout.Session.create_async(**session_args, idempotency_key=ikey)
+            return session.url, None
+
+        # Discounted: kick off the coupon lookup first (it doesn't depend on the session args).
+        # It's pooled or cached per percent, so a worker thread is fine.
+        coupon_task = None
+        if coupon_id is None:
+            coupon_task = asyncio.create_task(asyncio.to_thread(coupon_id_for, discount_percent))
+        session_args = build_session_args(customer_id, price_id, mode, metadata)
+        if coupon_task is not None:
+            coupon_id = await coupon_task
+
+        try:
+            url = await _create_discounted_session(session_args, customer_id, coupon_id, unique_code, ikey)
+        except stripe.InvalidRequestError as e:
+            # Cached coupon deleted in the dashboard: forget it, recreate it, try once more.
+            # Fresh keys, since the failed attempt may have been stored against the old ones.
+            if e.code != "resource_missing" or "coupon" not in (e.param or ""):
+                raise
+            await asyncio.to_thread(_forget_coupon, discount_percent) # Redis + cache locks; keep them off the loop
+            coupon_id = await asyncio.to_thread(coupon_id_for, discount_percent)
+            url = await _create_discounted_session(session_args, customer_id, coupon_id, unique_code, f"{ikey}-retry")
+        return url, None
+    except Exception as e:
+        return None, str(e)
+
+# Batch links in flight at once; each can be two Stripe calls with promotion codes on,
+# so this keeps a large selection well under Stripe's rate limit
+BATCH_CONCURRENCY = 8
+
+async def create_checkout_sessions(customer_id, items, discount_percent=0, unique_code=False):
+    """
+    Several sessions for one customer at once. items are (price_id, mode, metadata) tuples.
+    The coupon is resolved once up front, then up to BATCH_CONCURRENCY Session calls run at a time.
+    Returns [(url, err), ...] in the same order. Drive it with run_async().
+    """
+    coupon_id = None
+    if discount_percent > 0:
+        try:
+            coupon_id = await asyncio.to_thread(coupon_id_for, discount_percent)
+        except Exception:
+            pass # each create_checkout_session retries the lookup and reports the error
+
+    limit = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def create_one(price_id, mode, metadata):
+        async with limit:
+            return await create_checkout_session(
+                customer_id, price_id, mode, discount_percent,
+                metadata=metadata, unique_code=unique_code, coupon_id=coupon_id
+            )
+
+    return await asyncio.gather(*(create_one(*item) for item in items))
+
+# Customers created by this process: lowercased email -> (id, created_at). Search isn't
+# read-after-write consistent, so without Redis a resubmitted email would otherwise create
+# a second customer. Entries expire like the lookup cache, so a customer deleted or merged
+# in Stripe is looked up again after CUSTOMER_CACHE_TTL.
+_created_customer_ids: dict[str, tuple[str, float]] = {}
+
+def _created_customer_id(email_key):
+    entry = _created_customer_ids.get(email_key)
+    if entry and time.time() - entry[1] < CUSTOMER_CACHE_TTL:
+        return entry[0]
+    return None
+
+def _remember_created_customer(email_key, customer_id):
+    now = time.time()
+    # Prune on write so the map never holds more than one TTL's worth of creates
+    for key, (_, created_at) in list(_created_customer_ids.items()):
+        if now - created_at >= CUSTOMER_CACHE_TTL:
+            _created_customer_ids.pop(key, None)
+    _created_customer_ids[email_key] = (customer_id, now)
+
+def clear_customer_lookups():
+    """Forget every in-memory email -> customer answer: cached lookups and recent creates."""
+    _created_customer_ids.clear()
+    _lookup_customer_id_by_email.clear()
+
+@st.cache_data(ttl=CUSTOMER_CACHE_TTL, show_spinner=False)
+async def _lookup_customer_id_by_email(email_key, _email):
+    """
+    Existing customer ID for this email, or None. email_key is the lowercased email and the
+    only cache key (the underscore keeps _email out of it); _email is sent to Stripe as typed,
+    because the list filter is case-sensitive.
+    Misses are cached too, so clear the entry after creating that customer.
+    """
+    created_id = _created_customer_id(email_key)
+    if created_id:
+        return created_id
+
+    cache_key = _customer_cache_key(email_key)
+    cached_id = await asyncio.to_thread(get_generic_cache, cache_key)
+    if cached_id:
+        return cached_id
+
+    # Search hits Stripe's email index instead of filtering the customer list
+    query = "email:'{}'".format(_email.replace("'", "\\'"))
+    try:
+        found = await stripe.Customer.search_async(query=query, limit=1)
+    except stripe.InvalidRequestError:
+        # Search isn't offered in every region; the filtered list is the slower fallback
+        found = await stripe.Customer.list_async(email=_email, limit=1)
+    if not found.data:
+        return None
+
+    await asyncio.to_thread(set_generic_cache, cache_key, found.data[0].id, CUSTOMER_CACHE_TTL)
+    return found.data[0].id
+
+async def get_or_create_customer(email, name):
+    # The create depends on the lookup result, so these two stay sequential
+    try:
+        email_key = email.strip().lower()
+        existing_id = await _lookup_customer_id_by_email(email_key, email)
+        if existing_id:
+            return existing_id, True
+        
+        # Search can lag a freshly created customer; the key still catches a quick double-click
+        new_cus = await stripe.Customer.create_async(
+            email=email,
+            name=name,
+            idempotency_key=idempotency_key(email, name)
+        )
+        # Record the new ID before dropping the cached miss, so the next lookup finds it
+        # without Stripe's search (or Redis, when configured)
+        _remember_created_customer(email_key, new_cus.id)
+        _lookup_customer_id_by_email.clear(email_key)
+        await asyncio.to_thread(set_generic_cache, _customer_cache_key(email), new_cus.id, CUSTOMER_CACHE_TTL)
+        return new_cus.id, False
+    except Exception as e:
+        return None, False